@@ -1,11 +1,187 @@
+import io
+import logging
+import os
+import queue
+import tempfile
+import threading
+import zlib
+from collections import deque, OrderedDict
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from typing import Iterator, Tuple, Any, List
 import boto3
+import cv2
 import numpy as np
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from pathlib import Path
 
-from logic import log_exec_time
+from logic import log_exec_time, ImageStream
+
+logger = logging.getLogger(__name__)
+
+# botocore clients are thread-safe; one client with a pool wide enough for the
+# upload/download fan-out avoids "Connection pool is full" re-handshakes
+S3_MAX_POOL_CONNECTIONS = 64
+
+
+@lru_cache(maxsize=1)
+def shared_s3_client():
+    """
+    Process-wide S3 client, built on first use: endpoint/credential/config resolution
+    happens once, and processes that never touch S3 (local deployment) never pay for it.
+    """
+    return boto3.client("s3", config=Config(
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        retries={"mode": "adaptive", "max_attempts": 5},
+        tcp_keepalive=True,
+    ))
+
+# payloads at or above this size go through the transfer manager as parallel
+# multipart PUTs; anything smaller is a single put_object
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+transfer_config = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=MULTIPART_THRESHOLD,
+    max_concurrency=8,
+    use_threads=True,
+)
+
+# number of GET requests kept in flight while iterating a prefix
+IMAGE_PREFETCH = 16
+
+
+class _ETagCache:
+    """
+    Node-local cache of S3 object bodies, revalidated on every read with a conditional GET.
+    Bodies are stored on disk as `<directory>/<etag>`; the most recently used ones are also
+    kept in memory. Both tiers evict least-recently-used entries past their byte limit.
+    """
+    def __init__(self, directory, disk_limit: int, memory_limit: int):
+        self._dir = Path(directory)
+        self._disk_limit = disk_limit
+        self._memory_limit = memory_limit
+        self._lock = threading.Lock()
+        self._etags: dict[Tuple[str, str], str] = {}
+        # reverse of _etags, so evicting a body also forgets the keys that would revalidate against it
+        self._keys: dict[str, set[Tuple[str, str]]] = {}
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_size = 0
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_size = 0
+        self._load_existing()
+
+    def _load_existing(self) -> None:
+        """
+        Count bodies left in the directory by earlier runs or other processes sharing it, oldest
+        first, so they are subject to the disk limit too (their keys are unknown, so they only
+        age out). In-progress `.tmp` writes of other processes are left alone.
+        """
+        try:
+            entries = [(e.stat().st_mtime, e.name, e.stat().st_size)
+                       for e in os.scandir(self._dir) if e.is_file() and not e.name.endswith(".tmp")]
+        except OSError:
+            return
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_size += size
+        evicted = self._evict_disk()
+        for old in evicted:
+            (self._dir / old).unlink(missing_ok=True)
+
+    def _evict_disk(self) -> List[str]:
+        """Drop least-recently-used disk entries past the limit (caller holds the lock); returns the files to delete."""
+        evicted = []
+        while self._disk_size > self._disk_limit and len(self._disk) > 1:
+            old, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            for old_key in self._keys.pop(old, ()):
+                del self._etags[old_key]
+            evicted.append(old)
+        return evicted
+
+    def get(self, s3, bucket: str, key: str) -> bytes:
+        etag = self._etags.get((bucket, key))
+        if etag is not None:
+            try:
+                resp = s3.get_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+            except ClientError as exc:
+                if exc.response.get("Error", {}).get("Code") != "304":
+                    raise
+                data = self._read(etag)
+                if data is not None:
+                    return data
+                resp = s3.get_object(Bucket=bucket, Key=key)
+        else:
+            resp = s3.get_object(Bucket=bucket, Key=key)
+        data = resp["Body"].read()
+        self._write(bucket, key, resp["ETag"].strip('"'), data)
+        return data
+
+    def _read(self, etag: str) -> bytes | None:
+        with self._lock:
+            data = self._memory.get(etag)
+            if data is not None:
+                self._memory.move_to_end(etag)
+                return data
+            if etag in self._disk:
+                self._disk.move_to_end(etag)
+        try:
+            data = (self._dir / etag).read_bytes()
+        except OSError:
+            return None
+        self._remember(etag, data)
+        return data
+
+    def _write(self, bucket: str, key: str, etag: str, data: bytes) -> None:
+        try:
+            self._dir.mkdir(parents=True, exist_ok=True)
+            tmp = self._dir / f"{etag}.{threading.get_ident()}.tmp"
+            tmp.write_bytes(data)
+            os.replace(tmp, self._dir / etag)
+        except OSError:
+            # a full or read-only cache directory must not fail the request
+            return
+        with self._lock:
+            previous = self._etags.get((bucket, key))
+            if previous is not None and previous != etag:
+                self._keys[previous].discard((bucket, key))
+            self._etags[(bucket, key)] = etag
+            self._keys.setdefault(etag, set()).add((bucket, key))
+            self._disk_size += len(data) - self._disk.get(etag, 0)
+            self._disk[etag] = len(data)
+            self._disk.move_to_end(etag)
+            evicted = self._evict_disk()
+        for old in evicted:
+            (self._dir / old).unlink(missing_ok=True)
+        self._remember(etag, data)
+
+    def _remember(self, etag: str, data: bytes) -> None:
+        with self._lock:
+            if etag in self._memory:
+                return
+            self._memory[etag] = data
+            self._memory_size += len(data)
+            while self._memory_size > self._memory_limit and len(self._memory) > 1:
+                self._memory_size -= len(self._memory.popitem(last=False)[1])
+
+
+image_cache = _ETagCache(
+    os.getenv("s3_cache_dir", os.path.join(tempfile.gettempdir(), "s3img")),
+    disk_limit=int(os.getenv("s3_cache_disk_bytes", 256 * 1024 * 1024)),
+    memory_limit=int(os.getenv("s3_cache_memory_bytes", 64 * 1024 * 1024)),
+)
+
+def _as_encodable(img: Any) -> Any:
+    """Return img as a C-contiguous uint8 array, so imencode does not convert/copy it internally."""
+    if img.dtype != np.uint8:
+        img = np.clip(img, 0, 255).astype(np.uint8)
+    if not img.flags["C_CONTIGUOUS"]:
+        img = np.ascontiguousarray(img)
+    return img
 
-s3_client = boto3.client("s3")
 
 class S3ImageFileRepo:
     """
@@ -21,25 +197,23 @@ class S3ImageFileRepo:
 
     def __setstate__(self, state):
         self.__dict__.update(state)
-        self.s3 = state.get("s3") or s3_client
+        self.s3 = state.get("s3") or shared_s3_client()
 
-    def __init__(self, bucket: str, prefix: str = "", s3_client_param=s3_client):
+    def __init__(self, bucket: str, prefix: str = "", s3_client_param=None):
         self.bucket = bucket
         if not self.bucket:
             raise ValueError("S3 bucket name must be provided via argument or S3_BUCKET env var.")
         self.prefix = prefix.strip("/")
-        self.s3 = s3_client_param
+        self.s3 = s3_client_param or shared_s3_client()
+        # repos are cheap but handlers and extractors ask for the same children repeatedly
+        self._children: dict[str, "S3ImageFileRepo"] = {}
 
     def _full_key(self, key: str) -> str:
         if self.prefix:
             return f"{self.prefix}/{key}".lstrip("/")
         return key.lstrip("/")
 
-    def store_image(self, img: Any, name: str) -> str:
-        try:
-            import cv2
-        except Exception as exc:
-            raise RuntimeError("S3ImageFileRepo requires opencv-python (cv2)") from exc
+    def store_image(self, img: Any, name: str, encode_params: List[int] | None = None) -> str:
         if not name:
             raise ValueError("name must be a non-empty filename")
         if Path(name).name != name:
@@ -47,97 +221,154 @@ class S3ImageFileRepo:
         if not name.lower().endswith(".webp"):
             name = name + ".webp"
         try:
-            ok, buf = cv2.imencode(".webp", img)
+            ok, buf = cv2.imencode(".webp", _as_encodable(img), encode_params or [])
         except Exception:
             raise
         if not ok:
             raise RuntimeError("cv2.imencode failed to encode image as WEBP")
+        # cv2.imencode always allocates its own output, and botocore only accepts
+        # bytes/bytearray/str or file-like bodies (not memoryview), so one copy into
+        # bytes is the floor here; BytesIO below shares this buffer without copying
         data = buf.tobytes()
         key = self._full_key(name)
-        try:
-            self.s3.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType="image/webp")
-        except Exception:
-            raise
+        # objects are immutable once written, so the CRC32 needed when zipping them is computed once here
+        metadata = {"crc32": f"{zlib.crc32(data):08x}"}
+        if len(data) >= MULTIPART_THRESHOLD:
+            self.s3.upload_fileobj(io.BytesIO(data), self.bucket, key,
+                                   ExtraArgs={"ContentType": "image/webp", "Metadata": metadata},
+                                   Config=transfer_config)
+        else:
+            self.s3.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType="image/webp",
+                               Metadata=metadata)
         return f"s3://{self.bucket}/{key}"
 
     def iter_images(self) -> Iterator[Tuple[str, Any]]:
+        def fetch(key: str) -> Any:
+            # runs in a worker thread: cv2.imdecode releases the GIL, so decoding
+            # one object overlaps with the downloads of the others
+            data = image_cache.get(self.s3, self.bucket, key)
+            return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+        if not self.prefix:
+            # listing the bucket root would scan every session ever written
+            raise ValueError("iter_images requires a repo with a non-empty prefix (use sub_repo)")
+        # trailing slash lets S3 short-circuit the key-range scan to this "directory"
+        prefix = self.prefix.rstrip("/") + "/"
+        # listing runs one page ahead in its own thread so LIST latency hides behind the GETs
+        pages: queue.Queue = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        lister = threading.Thread(target=self._list_webp_keys, args=(prefix, pages, stop), daemon=True)
+        lister.start()
+        # FIFO of (key, future), capped at IMAGE_PREFETCH so memory stays bounded
+        in_flight: deque = deque()
+        with ThreadPoolExecutor(max_workers=IMAGE_PREFETCH) as executor:
+            try:
+                while (keys := pages.get()) is not None:
+                    if isinstance(keys, Exception):
+                        raise keys
+                    for key in keys:
+                        in_flight.append((key, executor.submit(fetch, key)))
+                        if len(in_flight) >= IMAGE_PREFETCH:
+                            yield self._take_decoded(in_flight)
+                while in_flight:
+                    yield self._take_decoded(in_flight)
+            finally:
+                # consumer stopped early or a fetch failed: drop what is still queued
+                stop.set()
+                for _, future in in_flight:
+                    future.cancel()
+
+    def _list_webp_keys(self, prefix: str, pages: queue.Queue, stop: threading.Event) -> None:
+        """
+        Put the .webp keys of each listing page on `pages`, then None; an exception is put instead
+        if the listing fails. Gives up once `stop` is set, so an abandoned iterator never leaks the thread.
+        """
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        paginator = self.s3.get_paginator("list_objects_v2")
         try:
-            import cv2
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix,
+                                           PaginationConfig={"PageSize": 1000}):
+                keys = [obj["Key"] for obj in page.get("Contents", []) if obj["Key"].lower().endswith(".webp")]
+                if not put(keys):
+                    return
         except Exception as exc:
-            raise RuntimeError("S3ImageFileRepo requires opencv-python (cv2)") from exc
-        prefix = self.prefix + "/" if self.prefix else ""
-        paginator = self.s3.get_paginator("list_objects_v2")
-        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
-            for obj in page.get("Contents", []):
-                key = obj["Key"]
-                if not key.lower().endswith(".webp"):
-                    continue
-                resp = self.s3.get_object(Bucket=self.bucket, Key=key)
-                data = resp["Body"].read()
-                arr = np.frombuffer(data, np.uint8)
-                img = cv2.imdecode(arr, cv2.IMREAD_UNCHANGED)
-                if img is None:
-                    raise RuntimeError(f"cv2.imdecode failed for S3 key: {key}")
-                yield Path(key).name, img
+            put(exc)
+            return
+        put(None)
+
+    @staticmethod
+    def _take_decoded(in_flight: deque) -> Tuple[str, Any]:
+        key, future = in_flight.popleft()
+        img = future.result()
+        if img is None:
+            raise RuntimeError(f"cv2.imdecode failed for S3 key: {key}")
+        return Path(key).name, img
 
     def sub_repo(self, sub_prefix: str) -> "S3ImageFileRepo":
-        new_prefix = f"{self.prefix}/{sub_prefix}" if self.prefix else sub_prefix
-        return S3ImageFileRepo(self.bucket, new_prefix, s3_client_param=self.s3)
+        child = self._children.get(sub_prefix)
+        if child is None:
+            new_prefix = f"{self.prefix}/{sub_prefix}" if self.prefix else sub_prefix
+            child = self._children.setdefault(
+                sub_prefix, S3ImageFileRepo(self.bucket, new_prefix, s3_client_param=self.s3))
+        return child
 
     @log_exec_time
-    def store_images(self, imgs: list, name: str) -> List[str]:
-        from concurrent.futures import ThreadPoolExecutor, as_completed
+    def store_images(self, imgs: list, name: str, encode_params: List[int] | None = None) -> List[str]:
+        if not imgs:
+            return []
         paths = [None] * len(imgs)
         def upload(idx_img):
             idx, img = idx_img
             img_name = f"{Path(name).stem}_{idx:03d}.webp"
             try:
-                result = self.store_image(img, img_name)
+                result = self.store_image(img, img_name, encode_params)
                 return idx, result
             except Exception:
                 return idx, None
-        with ThreadPoolExecutor() as executor:
+        # every worker shares self.s3; one thread per image up to the client's connection pool size
+        with ThreadPoolExecutor(max_workers=min(S3_MAX_POOL_CONNECTIONS, len(imgs))) as executor:
             futures = [executor.submit(upload, (idx, img)) for idx, img in enumerate(imgs)]
             for future in as_completed(futures):
                 idx, path = future.result()
                 paths[idx] = path
         return [str(p) for p in paths if p is not None]
 
-    def get_image(self, name: str) -> Any:
+    def _locate(self, name: str) -> Tuple[str, str]:
         """
-        Retrieve an image by filename from the S3 bucket/prefix.
-        Raises FileNotFoundError if the image does not exist or cannot be read.
-        Accepts either a plain filename (relative, no path traversal) or an s3://bucket/key URI.
+        Resolve a plain filename (relative, no path traversal) or an s3://bucket/key URI
+        to a (bucket, key) pair.
         """
-        try:
-            import cv2
-        except Exception as exc:
-            raise RuntimeError("S3ImageFileRepo requires opencv-python (cv2)") from exc
-        # Accept s3://bucket/key or just filename
         if name.startswith("s3://"):
             # Parse s3://bucket/key without regex
             uri = name[5:]  # remove 's3://'
             slash_idx = uri.find("/")
             if slash_idx == -1 or slash_idx == len(uri) - 1:
                 raise ValueError(f"Invalid S3 URI: {name}")
-            bucket = uri[:slash_idx]
-            key = uri[slash_idx+1:]
-        else:
-            # Only allow filename, no path traversal
-            if Path(name).name != name:
-                raise ValueError("name must be a filename without path components")
-            bucket = self.bucket
-            key = self._full_key(name)
-        try:
-            resp = self.s3.get_object(Bucket=bucket, Key=key)
-        except self.s3.exceptions.NoSuchKey:
-            raise FileNotFoundError(f"Image not found in S3: {bucket}/{key}")
-        except Exception as exc:
-            raise RuntimeError(f"Failed to fetch image from S3: {bucket}/{key}") from exc
-        data = resp["Body"].read()
-        arr = np.frombuffer(data, np.uint8)
-        img = cv2.imdecode(arr, cv2.IMREAD_UNCHANGED)
+            return uri[:slash_idx], uri[slash_idx+1:]
+        # Only allow filename, no path traversal
+        if Path(name).name != name:
+            raise ValueError("name must be a filename without path components")
+        return self.bucket, self._full_key(name)
+
+    def get_image(self, name: str) -> Any:
+        """
+        Retrieve an image by filename from the S3 bucket/prefix.
+        Raises FileNotFoundError if the image does not exist or cannot be read.
+        Accepts either a plain filename (relative, no path traversal) or an s3://bucket/key URI.
+        Callers that only forward the encoded file should use get_image_bytes and skip the decode.
+        """
+        # np.frombuffer is a zero-copy view over the downloaded bytes
+        img = cv2.imdecode(np.frombuffer(self.get_image_bytes(name), np.uint8), cv2.IMREAD_UNCHANGED)
         if img is None:
+            bucket, key = self._locate(name)
             raise RuntimeError(f"cv2.imdecode failed to read image from S3: {bucket}/{key}")
         return img
 
@@ -146,26 +377,30 @@ class S3ImageFileRepo:
         Retrieve the raw bytes of an image from S3, for use in zipping or direct download.
         Accepts either a plain filename (relative, no path traversal) or an s3://bucket/key URI.
         """
-        # Accept s3://bucket/key or just filename
-        if name.startswith("s3://"):
-            uri = name[5:]
-            slash_idx = uri.find("/")
-            if slash_idx == -1 or slash_idx == len(uri) - 1:
-                raise ValueError(f"Invalid S3 URI: {name}")
-            bucket = uri[:slash_idx]
-            key = uri[slash_idx+1:]
-        else:
-            if Path(name).name != name:
-                raise ValueError("name must be a filename without path components")
-            bucket = self.bucket
-            key = self._full_key(name)
+        bucket, key = self._locate(name)
+        try:
+            return image_cache.get(self.s3, bucket, key)
+        except self.s3.exceptions.NoSuchKey:
+            raise FileNotFoundError(f"Image not found in S3: {bucket}/{key}")
+        except Exception as exc:
+            raise RuntimeError(f"Failed to fetch image from S3: {bucket}/{key}") from exc
+
+    def get_image_stream(self, name: str) -> ImageStream:
+        """
+        Open the S3 object for streaming reads, bypassing the local cache; `body` is the
+        botocore StreamingBody, which the caller is responsible for closing. The CRC32 is
+        taken from the object metadata written by store_image, when present.
+        Accepts either a plain filename (relative, no path traversal) or an s3://bucket/key URI.
+        """
+        bucket, key = self._locate(name)
         try:
             resp = self.s3.get_object(Bucket=bucket, Key=key)
         except self.s3.exceptions.NoSuchKey:
             raise FileNotFoundError(f"Image not found in S3: {bucket}/{key}")
         except Exception as exc:
             raise RuntimeError(f"Failed to fetch image from S3: {bucket}/{key}") from exc
-        return resp["Body"].read()
+        crc = resp.get("Metadata", {}).get("crc32")
+        return ImageStream(resp["Body"], size=resp["ContentLength"], crc32=int(crc, 16) if crc else None)
 
 class S3PdfRetriever:
     """
@@ -180,7 +415,7 @@ class S3PdfRetriever:
         if not self.bucket:
             raise ValueError("S3 bucket name must be provided via argument or S3_BUCKET env var.")
         self.prefix = prefix.strip("/")
-        self.s3 = s3_client
+        self.s3 = shared_s3_client()
 
     def _full_key(self, key: str) -> str:
         if self.prefix:
@@ -203,22 +438,32 @@ class S3PdfRetriever:
             bucket = self.bucket
             key = self._full_key(name)
         try:
+            # a single GET for the typical PDF; download_fileobj would add a HEAD round trip first
             resp = self.s3.get_object(Bucket=bucket, Key=key)
-        except self.s3.exceptions.NoSuchKey:
-            raise FileNotFoundError(f"PDF not found in S3: {bucket}/{key}")
+            with closing(resp["Body"]) as body:
+                if resp["ContentLength"] < MULTIPART_THRESHOLD:
+                    return body.read()
+            # large PDFs: drop this response unread and let s3transfer fetch ranged parts in
+            # parallel straight into the buffer; getvalue() hands it back without another copy
+            buf = io.BytesIO()
+            self.s3.download_fileobj(bucket, key, buf, Config=transfer_config)
+            return buf.getvalue()
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                raise FileNotFoundError(f"PDF not found in S3: {bucket}/{key}") from exc
+            raise RuntimeError(f"Failed to fetch PDF from S3: {bucket}/{key}") from exc
         except Exception as exc:
             raise RuntimeError(f"Failed to fetch PDF from S3: {bucket}/{key}") from exc
-        return resp["Body"].read()
 
 def generate_presigned_url(bucket: str, key: str, expires_in: int = 3600, s3_client_param=None) -> str:
     """
     Generate a presigned S3 URL for PUT (upload) only.
-    Uses the provided s3_client_param or the default s3_client.
+    Uses the provided s3_client_param or the shared client.
     """
-    client = s3_client_param or s3_client
+    client = s3_client_param or shared_s3_client()
     ret =  client.generate_presigned_url(
         "put_object",
         Params={"Bucket": bucket, "Key": key},
         ExpiresIn=expires_in)
-    print(f"[ DEBUG] Generated presigned URL {ret}")
+    logger.debug("Generated presigned PUT URL for %s/%s", bucket, key)
     return ret
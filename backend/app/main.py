@@ -1,9 +1,13 @@
-import io
+import itertools
+import logging
 import os
-import zipfile
-import traceback
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Annotated, Iterator
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from fastapi import Depends, HTTPException, APIRouter, FastAPI, Body
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
@@ -14,23 +18,70 @@ from logic.color_vehicle import cluster_vehicle
 from logic.parsers import parse_page_list
 
 from aws.s3_logic import generate_presigned_url
+from zip_stream import ZipStreamWriter
+
+# debug output is off unless log_level=DEBUG; %-style arguments are only formatted when a record is emitted.
+# The level applies to this app's loggers only (botocore/urllib3 stay at the root's WARNING), and
+# an unknown value falls back to WARNING rather than failing at import
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+_log_level = os.getenv("log_level", "WARNING").upper()
+if _log_level not in logging.getLevelNamesMapping():
+    logger.warning("Unknown log_level %r, using WARNING", _log_level)
+    _log_level = "WARNING"
+for _name in ("logic", "aws", __name__):
+    logging.getLogger(_name).setLevel(_log_level)
+
+# number of files fetched concurrently while a ZIP is being streamed
+ZIP_FETCH_WORKERS = 16
+# bytes copied from a source stream into the archive per read
+ZIP_COPY_CHUNK = 1 << 20
+
+
+def _iter_zip_chunks(image_repo, file_paths: list[str]) -> Iterator[bytes]:
+    # WEBP payloads are already compressed, so entries are STORED
+    writer = ZipStreamWriter()
+    pending = iter(file_paths)
+    in_flight: deque = deque()
+    with ThreadPoolExecutor(max_workers=ZIP_FETCH_WORKERS) as executor:
+        def submit_next():
+            file_path = next(pending, None)
+            if file_path is not None:
+                in_flight.append((file_path, executor.submit(image_repo.get_image_stream, file_path)))
+
+        for _ in range(ZIP_FETCH_WORKERS):
+            submit_next()
+        try:
+            while in_flight:
+                file_path, future = in_flight.popleft()
+                submit_next()
+                try:
+                    image = future.result()
+                except Exception as exc:
+                    raise RuntimeError(f"Failed to fetch or add {file_path}: {exc}") from exc
+                # copy through a fixed-size buffer so RAM stays flat whatever the image size;
+                # a CRC stored alongside the object lets the bytes pass through untouched
+                with closing(image.body):
+                    yield from writer.write_entry(os.path.basename(file_path), image.body, ZIP_COPY_CHUNK,
+                                                  crc=image.crc32, size=image.size)
+        finally:
+            # release connections/file handles of streams that were opened but never copied
+            for _, future in in_flight:
+                if not future.cancel() and future.exception() is None:
+                    future.result().body.close()
+    yield writer.close()
 
 
 def stream_files_as_zip(image_repo, file_paths: list[str]):
-    zip_io = io.BytesIO()
-    with zipfile.ZipFile(zip_io, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for file_path in file_paths:
-            arc_name = os.path.basename(file_path)
-            try:
-                data = image_repo.get_image_bytes(file_path)
-                zf.writestr(arc_name, data)
-            except Exception as exc:
-                raise HTTPException(status_code=500, detail=f"Failed to fetch or add {file_path}: {exc}")
-    zip_io.seek(0)
-    zip_bytes = zip_io.getvalue()
-    print(f"[DEBUG] Returning ZIP of size: {len(zip_bytes)} bytes")
+    chunks = _iter_zip_chunks(image_repo, file_paths)
+    # produce the first entry eagerly so a failing fetch still maps to a 500
+    # instead of a truncated download
+    try:
+        first = next(chunks)
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
     return StreamingResponse(
-        io.BytesIO(zip_bytes),
+        itertools.chain([first], chunks),
         media_type="application/zip",
         headers={
             "Content-Disposition": "attachment; filename=files.zip",
@@ -40,47 +91,52 @@ def stream_files_as_zip(image_repo, file_paths: list[str]):
 
 def get_image_file_repo() -> ImageFileRepository:
     deployment = os.getenv("deployment", "local").lower()
-    print(f"[DEBUG] get_image_file_repo: deployment={deployment}")
+    logger.debug("get_image_file_repo: deployment=%s", deployment)
     if deployment == "local":
         from logic.file_repo import LocalImageFileRepo
         path = os.getenv("working_path", "output")
-        print(f"[DEBUG] Using LocalImageFileRepo with path={path}")
+        logger.debug("Using LocalImageFileRepo with path=%s", path)
         return LocalImageFileRepo(Path(path))
     elif deployment == "aws":
         from aws.s3_logic import S3ImageFileRepo
         bucket = os.getenv("s3_output_bucket", None)
         if bucket:
-            print(f"[DEBUG] Using S3ImageFileRepo with bucket={bucket}")
+            logger.debug("Using S3ImageFileRepo with bucket=%s", bucket)
             return S3ImageFileRepo(bucket)
-    print(f"[DEBUG] Unsupported deployment type: {deployment}")
+    logger.debug("Unsupported deployment type: %s", deployment)
     raise ValueError(f"Unsupported deployment type: {deployment}")
 
 def pdf_retriever() -> PdfRetriever:
     deployment = os.getenv("deployment", "local").lower()
-    print(f"[DEBUG] get_image_file_repo: deployment={deployment}")
+    logger.debug("pdf_retriever: deployment=%s", deployment)
     if deployment == "local":
         from logic.file_repo import LocalPdfRetriever
-        print(f"[DEBUG] UsingLocalPdfRetriever")
+        logger.debug("Using LocalPdfRetriever")
         return LocalPdfRetriever(".")
     elif deployment == "aws":
         from aws.s3_logic import S3PdfRetriever
         bucket = os.getenv("s3_input_bucket", None)
         if bucket:
-            print(f"[DEBUG] Using S3ImageFileRepo with bucket={bucket}")
+            logger.debug("Using S3PdfRetriever with bucket=%s", bucket)
             return S3PdfRetriever(bucket)
-    print(f"[DEBUG] Unsupported deployment type: {deployment}")
+    logger.debug("Unsupported deployment type: %s", deployment)
     raise ValueError(f"Unsupported deployment type: {deployment}")
 
 def create_page_filter(pages: str = "", threshold: int = 3):
-    deployment = os.getenv("deployment", "local")
-    print(f"[DEBUG] create_page_filter: deployment={deployment}, pages={pages}, threshold={threshold}")
-    pages_of_interest: set[int] = parse_page_list(pages)
+    return _page_filter(pages, threshold, os.getenv("deployment", "local"))
+
+# filters are read-only after construction, so one instance per (pages, threshold, deployment)
+# is safely shared across requests and threads
+@lru_cache(maxsize=256)
+def _page_filter(pages: str, threshold: int, deployment: str):
+    logger.debug("create_page_filter: deployment=%s, pages=%s, threshold=%s", deployment, pages, threshold)
+    pages_of_interest: frozenset[int] = frozenset(parse_page_list(pages))
     if deployment == "local":
          from local import OcrPageFilter
-         print(f"[DEBUG] Using OcrPageFilter with pages_of_interest={pages_of_interest}")
+         logger.debug("Using OcrPageFilter with pages_of_interest=%s", pages_of_interest)
          return OcrPageFilter(pages_of_interest, threshold)
     from logic import PageFilter
-    print(f"[DEBUG] Using logic.PageFilter with pages_of_interest={pages_of_interest}")
+    logger.debug("Using logic.PageFilter with pages_of_interest=%s", pages_of_interest)
     return PageFilter(pages_of_interest)
 
 router = APIRouter(prefix="/api/v1/color_vehicles", tags=["color_vehicles"])
@@ -94,27 +150,25 @@ class ProcessPdfRequest(BaseModel):
 
 
 @router.post("/process_pdf")
-async def api_process_pdf(
+def api_process_pdf(
     request: ProcessPdfRequest = Body(...),
     image_repo = Depends(get_image_file_repo),
     pdf_repo = Depends(pdf_retriever)
 ):
     try:
-        print(f"[DEBUG] /process_pdf called with: {request}")
-        print(f"[DEBUG] Attempting to load PDF from: {request.pdf_path}")
+        logger.debug("/process_pdf called with pdf_path=%s, dpi=%s, pages=%s, threshold=%s",
+                     request.pdf_path, request.dpi, request.pages, request.threshold)
         contents = pdf_repo.get_pdf_bytes(request.pdf_path)
-        print(f"[DEBUG] PDF loaded, size={len(contents)} bytes")
+        logger.debug("PDF loaded, size=%d bytes", len(contents))
         page_filter = create_page_filter(request.pages, request.threshold)
-        print(f"[DEBUG] Calling process_pdf with dpi={request.dpi}")
         roi_path, uuid_string = process_pdf(contents, request.dpi, image_repo, page_filter)
-        print(f"[DEBUG] process_pdf returned roi_path={roi_path}, session={uuid_string}")
+        logger.debug("process_pdf returned roi_path=%s, session=%s", roi_path, uuid_string)
         return {
             "images": [roi_path],
             "session": uuid_string
         }
     except Exception as exc:
-        print(f"[ERROR] Exception in /process_pdf: {exc}")
-        traceback.print_exc()
+        logger.exception("Exception in /process_pdf")
         raise HTTPException(status_code=500, detail=str(exc))
 
 class PreviewImageRequest(BaseModel):
@@ -124,19 +178,18 @@ class PreviewImageRequest(BaseModel):
 
 @router.post("/preview_image")
 def preview_image(request: PreviewImageRequest = Body(...), image_repo = Depends(get_image_file_repo)):
-    print(f"[DEBUG] /preview_image called with image_path={request.image}")
+    logger.debug("/preview_image called with image_path=%s", request.image)
     try:
+        session_repo = image_repo.sub_repo(request.session)
         preview_path, centroids = cluster_vehicle(request.image, request.clusters,
-                              image_repo.sub_repo(request.session).sub_repo("roi")
-                                                  , image_repo.sub_repo(request.session))
-        print(f"[DEBUG] cluster_vehicle returned: preview_path={preview_path}, centroids={centroids}")
+                                                  session_repo.sub_repo("roi"), session_repo)
+        logger.debug("cluster_vehicle returned: preview_path=%s, centroids=%s", preview_path, centroids)
         return {
             "images": [preview_path],
             "centroids": centroids,
         }
     except Exception as exc:
-        print(f"[ERROR] Exception in /preview_image: {exc}")
-        traceback.print_exc()
+        logger.exception("Exception in /preview_image")
         raise HTTPException(status_code=500, detail=str(exc))
 
 class DownloadImagesRequest(BaseModel):
@@ -146,41 +199,43 @@ class DownloadImagesRequest(BaseModel):
 
 @router.post("/download_images")
 def download_images(request: DownloadImagesRequest = Body(...), image_repo = Depends(get_image_file_repo)):
-    print(f"[DEBUG] /download_images called with: {request}")
+    logger.debug("/download_images called with %d images, session=%s, folder=%s",
+                 len(request.images), request.session, request.folder)
     try:
         repo = image_repo.sub_repo(request.session)
         if request.folder:
             repo = repo.sub_repo(request.folder)
-            print(f"[DEBUG] Using sub-repo for folder: {request.folder}")
 
-        response = stream_files_as_zip(repo, request.images)
-        print(f"[DEBUG] stream_files_as_zip returned StreamingResponse")
-        return response
+        return stream_files_as_zip(repo, request.images)
     except Exception as exc:
-        print(f"[ERROR] Exception in /download_images: {exc}")
-        traceback.print_exc()
+        logger.exception("Exception in /download_images")
         raise HTTPException(status_code=500, detail=str(exc))
 
 class ApplyColorMappingRequest(BaseModel):
     clusters: int
     colors: str
     session: str
+    # centroids returned by /preview_image; when set, images are mapped through them instead of
+    # re-clustered, and they take precedence over `clusters`
+    centroids: list[Annotated[int, Field(ge=0, le=255)]] | None = None
 
 @router.post("/apply_color_mapping")
-async def api_apply_color_mapping(
+def api_apply_color_mapping(
     request: ApplyColorMappingRequest = Body(...),
     image_repo = Depends(get_image_file_repo)
 ):
     try:
-        print(f"[DEBUG] /apply_color_mapping called with: {request}")
-        extracted_repo = image_repo.sub_repo(request.session).sub_repo("vehicles")
-        color_repo = image_repo.sub_repo(request.session).sub_repo("colorized")
-        print(f"[DEBUG] Calling apply_color_mapping with clusters={request.clusters}, colors={request.colors}")
-        result = apply_color_mapping(request.clusters, request.colors, extracted_repo, color_repo)
-        print(f"[DEBUG] apply_color_mapping returned: {result}")
+        logger.debug("/apply_color_mapping called with clusters=%s, colors=%s, session=%s",
+                     request.clusters, request.colors, request.session)
+        session_repo = image_repo.sub_repo(request.session)
+        extracted_repo = session_repo.sub_repo("vehicles")
+        color_repo = session_repo.sub_repo("colorized")
+        result = apply_color_mapping(request.clusters, request.colors, extracted_repo, color_repo,
+                                     request.centroids)
+        logger.debug("apply_color_mapping returned %d images", len(result))
         return { "images": result }
     except Exception as exc:
-        print(f"[ERROR] Exception in /apply_color_mapping: {exc}")
+        logger.exception("Exception in /apply_color_mapping")
         raise HTTPException(status_code=500, detail=str(exc))
 
 class GetSignedUrlRequest(BaseModel):
@@ -0,0 +1,104 @@
+"""
+Minimal streaming writer for ZIP archives whose entries are STORED (no compression).
+
+zipfile always computes the CRC32 of written data itself and cannot take one supplied
+by the caller; this writer emits the archive as a sequence of byte chunks without
+seeking, computes CRC32 with ISA-L when it is installed, and accepts a precomputed
+CRC/size so entries can be copied without touching their bytes.
+Archives are limited to the classic (non-ZIP64) format: 4 GiB and 65535 entries.
+"""
+import struct
+import time
+from typing import BinaryIO, Iterator
+
+try:
+    # ISA-L's crc32 is PCLMULQDQ-accelerated and a drop-in for zlib.crc32
+    from isal.isal_zlib import crc32
+except ImportError:
+    from zlib import crc32
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_DATA_DESCRIPTOR = struct.Struct("<IIII")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIR = struct.Struct("<IHHHHIIH")
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_VERSION = 20
+_MAX_32 = 0xFFFFFFFF
+_MAX_ENTRIES = 0xFFFF
+
+
+def _dos_datetime(timestamp: float) -> tuple[int, int]:
+    t = time.localtime(timestamp)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ZipStreamWriter:
+    """
+    Usage:
+        writer = ZipStreamWriter()
+        for name, stream in files:
+            yield from writer.write_entry(name, stream)
+        yield writer.close()
+    """
+    def __init__(self):
+        self._offset = 0
+        self._central: list[bytes] = []
+        self._dos_time, self._dos_date = _dos_datetime(time.time())
+
+    def write_entry(self, name: str, stream: BinaryIO, chunk_size: int = 1 << 20,
+                    crc: int | None = None, size: int | None = None) -> Iterator[bytes]:
+        """
+        Yield the local header, the data of `stream` copied in `chunk_size` reads, and,
+        when `crc`/`size` were not supplied, a trailing data descriptor.
+        """
+        if len(self._central) >= _MAX_ENTRIES:
+            raise ValueError("Too many entries for a non-ZIP64 archive")
+        try:
+            encoded = name.encode("ascii")
+            flags = 0
+        except UnicodeEncodeError:
+            encoded = name.encode("utf-8")
+            flags = _FLAG_UTF8
+        known = crc is not None and size is not None
+        if not known:
+            flags |= _FLAG_DATA_DESCRIPTOR
+        header_offset = self._offset
+        header = _LOCAL_HEADER.pack(0x04034B50, _VERSION, flags, 0, self._dos_time, self._dos_date,
+                                    crc if known else 0, size if known else 0, size if known else 0,
+                                    len(encoded), 0) + encoded
+        self._offset += len(header)
+        yield header
+
+        written = 0
+        running_crc = 0
+        while chunk := stream.read(chunk_size):
+            if not known:
+                running_crc = crc32(chunk, running_crc)
+            written += len(chunk)
+            yield chunk
+        self._offset += written
+        if known:
+            if written != size:
+                raise ValueError(f"{name}: expected {size} bytes, read {written}")
+            running_crc = crc
+        else:
+            descriptor = _DATA_DESCRIPTOR.pack(0x08074B50, running_crc, written, written)
+            self._offset += len(descriptor)
+            yield descriptor
+        if written > _MAX_32 or self._offset > _MAX_32:
+            raise ValueError("Archive too large for the non-ZIP64 format")
+
+        self._central.append(_CENTRAL_HEADER.pack(
+            0x02014B50, _VERSION, _VERSION, flags, 0, self._dos_time, self._dos_date,
+            running_crc, written, written, len(encoded), 0, 0, 0, 0, 0, header_offset) + encoded)
+
+    def close(self) -> bytes:
+        """Return the central directory and end-of-archive record."""
+        directory = b"".join(self._central)
+        end = _END_OF_CENTRAL_DIR.pack(0x06054B50, 0, 0, len(self._central), len(self._central),
+                                       len(directory), self._offset, 0)
+        return directory + end
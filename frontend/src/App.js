@@ -18,6 +18,13 @@ function App() {
   const [previewImg, setPreviewImg] = useState(null);
   const [s3PdfUri, setS3PdfUri] = useState("");
 
+  // centroids from a preview only describe the K they were computed for; once K changes
+  // apply_color_mapping has to re-cluster instead of reusing them
+  const handleKChange = (e) => {
+    setK(Number(e.target.value));
+    setCentroids(null);
+  };
+
   // Step 1: File or URL selection
   const handlePdfChange = (e) => setPdf(e.target.files[0]);
   const handlePdfUrlChange = (e) => setPdfUrl(e.target.value);
@@ -104,6 +111,7 @@ function App() {
       clusters: K,
       colors: colorInput,
       session: session,
+      centroids: centroids,
     });
     // Step 6: Download image zip
     const zipRes = await axios.post(
@@ -138,7 +146,7 @@ function App() {
       </div>
       <div>
         <label>Number of clusters (K):</label>
-        <input type="range" min={1} max={50} value={K} onChange={e => setK(Number(e.target.value))} />
+        <input type="range" min={1} max={50} value={K} onChange={handleKChange} />
         <span>{K}</span>
       </div>
       <div>
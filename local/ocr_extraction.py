@@ -1,23 +1,42 @@
 import cv2
 import pytesseract
 
+from typing import Callable
+
 from logic.page_filter import PageFilter
-from logic.paint_detection import is_painting_page
+from logic.paint_detection import is_painting_text
+
+# longest side fed to Tesseract: keyword/code detection needs ~150 DPI, and OCR time grows with area
+OCR_MAX_SIDE = 1800
+# single uniform block (skips layout analysis), LSTM engine only
+OCR_CONFIG = "--psm 6 --oem 1"
 
-def _ocr_page_image(img) -> str:
+def _ocr_page(img) -> str:
+    scale = min(1.0, OCR_MAX_SIDE / max(img.shape[:2]))
+    if scale < 1.0:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     gray = cv2.GaussianBlur(gray, (3, 3), 0)
 
     # simple threshold often helps OCR on scans
     _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
-    ret =  pytesseract.image_to_string(bw, lang="eng")
-    return ret
+    # one Tesseract run per page: most pages never reach the threshold, so splitting the page to
+    # stop early would cost them extra process launches and re-read overlap rows
+    return pytesseract.image_to_string(bw, lang="eng", config=OCR_CONFIG)
 
 class OcrPageFilter(PageFilter):
-    def __init__(self, considered_pages: set, threshold : int) -> None:
+    def __init__(self, considered_pages: set | frozenset, threshold : int) -> None:
         super().__init__(considered_pages)
         self.threshold = threshold
 
-    def filter_page(self, page: int, values: cv2.typing.MatLike ) -> bool:
-        return self.consider_page(page) and (self.threshold < 0 or is_painting_page(values, _ocr_page_image, self.threshold))
\ No newline at end of file
+    def filter_page(self, page: int, values: cv2.typing.MatLike,
+                    embedded_text: Callable[[], str] | None = None) -> bool:
+        if not self.consider_page(page):
+            return False
+        if self.threshold < 0:
+            return True
+        # born-digital pages may qualify on their text layer alone, without running Tesseract
+        if embedded_text is not None and is_painting_text([embedded_text()], self.threshold):
+            return True
+        return is_painting_text([_ocr_page(values)], self.threshold)
\ No newline at end of file
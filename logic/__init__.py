@@ -1,9 +1,9 @@
 from .color_vehicle import process_pdf, apply_color_mapping
-from .file_repo import ImageFileRepository, LocalImageFileRepo, PdfRetriever, LocalPdfRetriever
+from .file_repo import ImageFileRepository, ImageStream, LocalImageFileRepo, PdfRetriever, LocalPdfRetriever
 from .utils import log_exec_time
 from .page_filter import PageFilter
 __all__ = ["process_pdf", "apply_color_mapping",
-           "ImageFileRepository", "LocalImageFileRepo",
+           "ImageFileRepository", "ImageStream", "LocalImageFileRepo",
            "log_exec_time", "PageFilter", "PdfRetriever"]
 
 
@@ -1,3 +1,5 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, List
 import cv2
 import numpy as np
@@ -20,6 +22,9 @@ from .page_filter import PageFilter
 
 Color = Tuple[int, int, int]
 
+# threads used to colorize and store the images of one apply_color_mapping call
+COLOR_WORKERS = 16
+
 def process_pdf(pdf_file, dpi, out_repo: ImageFileRepository, page_filter: PageFilter) -> Tuple[str | None, str]:
     uuid_string = str(uuid.uuid4())
     items = process_pdf_pages(pdf_file, out_repo.sub_repo(uuid_string), page_filter, dpi)
@@ -29,6 +34,18 @@ def process_pdf(pdf_file, dpi, out_repo: ImageFileRepository, page_filter: PageF
 # -------------------------------------------------------------
 # FUNCTION: Cluster pixels and return centroid image + cluster data
 # -------------------------------------------------------------
+def _nearest_centroid(levels: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    Index of the nearest centroid for each level. In 1D the nearest-centroid regions are the
+    intervals between midpoints of the sorted centroids, so a binary search replaces the (M, K)
+    distance matrix.
+    """
+    order = np.argsort(centroids, kind="stable")
+    ordered = centroids[order].astype(np.float64)
+    boundaries = 0.5 * (ordered[:-1] + ordered[1:])
+    return order[np.searchsorted(boundaries, levels)]
+
+
 def _kmeans_1d_weighted(levels: np.ndarray, weights: np.ndarray, cluster_count: int, max_iter: int = 50, tol: float = 1e-3):
     """
     Weighted 1D kmeans on `levels` with `weights`. Returns centroids (float).
@@ -41,13 +58,16 @@ def _kmeans_1d_weighted(levels: np.ndarray, weights: np.ndarray, cluster_count:
         return np.linspace(levels.min(), levels.max(), cluster_count)
     quantiles = (np.linspace(0, 1, cluster_count + 2)[1:-1] * cum[-1])
     centroids = np.interp(quantiles, cum, levels).astype(np.float64)
+    # the per-level products do not change between iterations. Callers pass calcHist counts, whose
+    # float32 bins are whole numbers only up to 2**24 pixels per gray level (far above a vehicle
+    # crop or ROI); bincount then sums level * weight in float64
+    level_weights = levels * weights
 
     for _ in range(max_iter):
         # assign each level to nearest centroid
-        d = np.abs(levels[:, None] - centroids[None, :])  # (M, K)
-        labels = np.argmin(d, axis=1)
+        labels = _nearest_centroid(levels, centroids)
         # compute weighted sums per cluster
-        weighted_sums = np.bincount(labels, weights=levels * weights, minlength=cluster_count)
+        weighted_sums = np.bincount(labels, weights=level_weights, minlength=cluster_count)
         weight_sums = np.bincount(labels, weights=weights, minlength=cluster_count)
         # handle empty clusters by reassigning to the largest remaining weight level
         new_centroids = centroids.copy()
@@ -95,7 +115,7 @@ def _cluster_vehicle(img: np.ndarray | None, cluster_count: int,  out_repo: Imag
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
     # histogram of grayscale values (0..255)
-    counts = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    counts = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel().astype(np.int64)
     total = counts.sum()
     if total == 0:
         raise ValueError("Empty image in cluster_vehicle")
@@ -103,71 +123,105 @@ def _cluster_vehicle(img: np.ndarray | None, cluster_count: int,  out_repo: Imag
     n_unique = int(np.count_nonzero(counts))
     n_clusters = min(cluster_count, n_unique) if n_unique > 0 else 1
 
-    levels = np.arange(256, dtype=np.float64)  # 0..255
+    levels = np.arange(256, dtype=np.int64)  # 0..255
     centroids = _kmeans_1d_weighted(levels, counts, n_clusters, max_iter=100, tol=1e-2)
     # ensure centroids are in 0..255 and as uint8
     centroids = np.clip(np.round(centroids), 0, 255).astype(np.uint8)
 
     # map each level to nearest centroid
-    d = np.abs(levels[:, None] - centroids[None, :])  # (256, n_clusters)
-    labels_levels = np.argmin(d, axis=1)  # for each level 0..255 -> cluster index
+    labels_levels = _nearest_centroid(levels, centroids)  # for each level 0..255 -> cluster index
     lut = centroids[labels_levels]  # map level -> centroid_gray
-
-    mapped_gray = lut[gray]  # vectorized mapping
-    out = np.dstack([mapped_gray, mapped_gray, mapped_gray]).astype(np.uint8)
-
     # preserve black/white regions
-    out[gray < 50] = (0, 0, 0)
-    out[gray > 245] = (255, 255, 255)
+    lut[:50] = 0
+    lut[246:] = 255
+
+    # single-channel table lookup, then replicate into the 3 output channels
+    out = cv2.cvtColor(cv2.LUT(gray, lut), cv2.COLOR_GRAY2BGR)
 
     return  out_repo.store_image(out, "clustered_preview.webp"), centroids.tolist()
 
 # -------------------------------------------------------------
 # FUNCTION: Apply final color mapping
 # -------------------------------------------------------------
-def apply_color_mapping(cluster_count: int, colors: str, in_repo: ImageFileRepository, out_repo: ImageFileRepository) -> List[MatLike]:
+def apply_color_mapping(cluster_count: int, colors: str, in_repo: ImageFileRepository, out_repo: ImageFileRepository,
+                        centroids: List[int] | None = None) -> List[str]:
+    """
+    Colorize every image in in_repo. When `centroids` (as returned by cluster_vehicle for the
+    preview) are given, the color LUT is built once from them and every image is only mapped
+    through it; `centroids` then wins over `cluster_count`, which is not used. Otherwise each
+    image is clustered into `cluster_count` levels on its own.
+    """
     color_ranges: RangeMap = parse_color_ranges(colors)
-    paths = []
-    for name, img in in_repo.iter_images():
-        out = _apply_color_to_image(cluster_count, color_ranges, img)
-        paths.append(out_repo.store_image(out, name))
-    return paths
-
-
-def _apply_color_to_image(cluster_count: int, color_ranges: RangeMap,
-                          img: MatLike) -> MatLike:
-    img = np.asarray(img)
-    gray: np.ndarray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    # histogram and cluster on 256 gray levels using the weighted 1D kmeans already in this file
-    counts = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
-    total = counts.sum()
-    if total == 0:
-        raise ValueError("Empty image in apply_color_mapping")
-
-    n_unique = int(np.count_nonzero(counts))
-    n_clusters = min(cluster_count, n_unique) if n_unique > 0 else 1
-
+    lut = _build_color_lut(np.asarray(centroids, dtype=np.uint8), color_ranges) if centroids else None
+
+    def color_and_store(item: Tuple[str, MatLike]) -> str:
+        name, img = item
+        return out_repo.store_image(_apply_color_to_image(cluster_count, color_ranges, img, lut), name)
+
+    # the per-pixel LUT work, the WEBP encode and the upload all release the GIL, so threads
+    # overlap them across images without shipping images to other processes; images are pulled
+    # from the repo as workers free up, so at most COLOR_WORKERS decoded images are held at once
+    images = iter(in_repo.iter_images())
+    in_flight: deque = deque()
+    names: List[str] = []
+    with ThreadPoolExecutor(max_workers=COLOR_WORKERS) as executor:
+        def submit_next():
+            item = next(images, None)
+            if item is not None:
+                in_flight.append(executor.submit(color_and_store, item))
+
+        for _ in range(COLOR_WORKERS):
+            submit_next()
+        while in_flight:
+            future = in_flight.popleft()
+            submit_next()
+            names.append(future.result())
+    return names
+
+
+def _build_color_lut(centroids: np.ndarray, color_ranges: RangeMap) -> np.ndarray:
+    """
+    Build the final RGB LUT for every input gray level by looking up its nearest centroid gray in color_ranges.
+    """
     levels = np.arange(256, dtype=np.float64)
-    centroids = _kmeans_1d_weighted(levels, counts, n_clusters, max_iter=100, tol=1e-2)
-    centroids = np.clip(np.round(centroids), 0, 255).astype(np.uint8)
-
     # map each original gray level (0..255) to its centroid index
-    d = np.abs(levels[:, None] - centroids[None, :])  # (256, n_clusters)
-    labels_levels = np.argmin(d, axis=1)  # for each level -> cluster index
+    labels_levels = _nearest_centroid(levels, centroids)  # for each level -> cluster index
 
-    # Build a final RGB LUT for every input gray level by looking up the centroid gray in color_ranges
-    final_rgb = np.zeros((256, 3), dtype=np.uint8)
-    for lvl in range(256):
-        cent_g = int(centroids[labels_levels[lvl]])
+    # resolve the RangeMap once per centroid (K lookups, not 256), then gather per level
+    cent_rgb = np.empty((len(centroids), 3), dtype=np.uint8)
+    for idx, cent in enumerate(centroids):
+        cent_g = int(cent)
         default_val = (cent_g, cent_g, cent_g)
         raw_val = lookup_with_default(color_ranges, cent_g, default_val)
-        final_rgb[lvl] = (int(raw_val[0]), int(raw_val[1]), int(raw_val[2]))
+        cent_rgb[idx] = (int(raw_val[0]), int(raw_val[1]), int(raw_val[2]))
+    final_rgb = cent_rgb[labels_levels]
+    # preserve black/white regions
+    final_rgb[:50] = 0
+    final_rgb[246:] = 255
+    return final_rgb
 
-    # Apply LUT vectorized and preserve black/white regions
-    out = final_rgb[gray]  # shape (h, w, 3)
-    out = out.copy()
-    out[gray < 50] = (0, 0, 0)
-    out[gray > 245] = (255, 255, 255)
-    return out
 
+def _apply_color_to_image(cluster_count: int, color_ranges: RangeMap,
+                          img: MatLike, lut: np.ndarray | None = None) -> MatLike:
+    img = np.asarray(img)
+    gray: np.ndarray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    final_rgb = lut
+    if final_rgb is None:
+        # histogram and cluster on 256 gray levels using the weighted 1D kmeans already in this file
+        counts = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel().astype(np.int64)
+        total = counts.sum()
+        if total == 0:
+            raise ValueError("Empty image in apply_color_mapping")
+
+        n_unique = int(np.count_nonzero(counts))
+        n_clusters = min(cluster_count, n_unique) if n_unique > 0 else 1
+
+        levels = np.arange(256, dtype=np.int64)
+        centroids = _kmeans_1d_weighted(levels, counts, n_clusters, max_iter=100, tol=1e-2)
+        centroids = np.clip(np.round(centroids), 0, 255).astype(np.uint8)
+        final_rgb = _build_color_lut(centroids, color_ranges)
+
+    # Apply LUT with OpenCV's vectorized table lookup (a 3-channel source against a 256x3 table);
+    # black/white preservation is baked into the LUT
+    return cv2.LUT(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), final_rgb.reshape(1, 256, 3))
@@ -1,22 +1,38 @@
-from typing import Protocol, Iterator, TYPE_CHECKING, Any, runtime_checkable, Tuple, List
+from typing import Protocol, Iterator, TYPE_CHECKING, Any, runtime_checkable, Tuple, List, BinaryIO, NamedTuple
+import logging
+import os
+from functools import cached_property
 from pathlib import Path
+import cv2
 
 if TYPE_CHECKING:
-    import cv2  # type: ignore
     MatLike = cv2.typing.MatLike  # type: ignore
 else:
     MatLike = Any
 
+logger = logging.getLogger(__name__)
+
+class ImageStream(NamedTuple):
+    """Readable image payload plus its size and CRC32 when the store knows them without reading it."""
+    body: BinaryIO
+    size: int | None = None
+    crc32: int | None = None
+
 @runtime_checkable
 class ImageFileRepository(Protocol):
+    """
+    Store of encoded images. get_image_bytes / get_image_stream return the stored file as-is and
+    are what anything forwarding files (e.g. zipping a download) should use; get_image and
+    iter_images decode to a MatLike and are only for callers that need pixels.
+    """
     def iter_images(self) -> Iterator[Tuple[str, MatLike]]:
         ...
     def get_image(self, name: str) -> MatLike:
         ...
-    def store_image(self, img: MatLike, name: str) -> str:
+    def store_image(self, img: MatLike, name: str, encode_params: List[int] | None = None) -> str:
         ...
 
-    def store_images(self, imgs: List[MatLike], name: str) -> List[str]:
+    def store_images(self, imgs: List[MatLike], name: str, encode_params: List[int] | None = None) -> List[str]:
         ...
 
     def sub_repo(self, name: str) -> "ImageFileRepository":
@@ -25,6 +41,9 @@ class ImageFileRepository(Protocol):
     def get_image_bytes(self, name: str) -> bytes:
         ...
 
+    def get_image_stream(self, name: str) -> ImageStream:
+        ...
+
 
 # Example concrete implementation (optional; requires opencv-python and numpy)
 class LocalImageFileRepo:
@@ -48,21 +67,26 @@ class LocalImageFileRepo:
         if not self._dir.is_dir():
             raise ValueError(f"Path is not a directory: {self._dir}")
 
-        # collect WEBP files (case-insensitive) in the directory (non-recursive)
-        pngs = []
-        for entry in self._dir.iterdir():
-            if entry.is_file():
-                if entry.suffix.lower() == ".webp":
-                    pngs.append(str(entry))
+    @classmethod
+    def _for_existing_dir(cls, directory: Path) -> "LocalImageFileRepo":
+        # for directories the caller has just created/checked: skip __init__'s checks
+        repo = cls.__new__(cls)
+        repo._dir = directory
+        return repo
+
+    @cached_property
+    def _paths(self) -> List[str]:
+        # listed on first iteration, not on construction: most repos (e.g. fresh session
+        # sub-repos) are only written to.
+        # collect WEBP files (case-insensitive) in the directory (non-recursive);
+        # scandir entries carry the file type from the directory read, so no stat() per file
+        with os.scandir(self._dir) as entries:
+            pngs = [entry.path for entry in entries
+                    if entry.name.lower().endswith(".webp") and entry.is_file()]
         # keep stable ordering
-        self._paths = sorted(pngs)
+        return sorted(pngs)
 
     def iter_images(self) -> Iterator[Tuple[str, MatLike]]:
-        try:
-            import cv2
-        except Exception as exc:
-            raise RuntimeError("LocalImageFileRepo requires opencv-python (cv2)") from exc
-
         for path in self._paths:
             mat = cv2.imread(path, cv2.IMREAD_UNCHANGED)
             if mat is None:
@@ -70,12 +94,10 @@ class LocalImageFileRepo:
                 raise RuntimeError(f"cv2.imread failed to read image: {path}")
             yield Path(path).name, mat
 
-    def store_image(self, img: MatLike, name: str) -> str:
-        try:
-            import cv2
-        except Exception as exc:
-            raise RuntimeError("LocalImageFileRepo requires opencv-python (cv2)") from exc
-
+    def store_image(self, img: MatLike, name: str, encode_params: List[int] | None = None) -> str:
+        """
+        Write img under `name`; `encode_params` are passed to cv2.imwrite (e.g. [cv2.IMWRITE_WEBP_QUALITY, 80]).
+        """
         if not name:
             raise ValueError("name must be a non-empty filename")
         # disallow path traversal / directories in the provided name
@@ -89,8 +111,8 @@ class LocalImageFileRepo:
 
         # write the image directly with OpenCV (no temp files)
         str_path = str(out_path)
-        ok = cv2.imwrite(str_path, img)
-        print( f"Writing image to {str(out_path.resolve())}, success: {ok}")
+        ok = cv2.imwrite(str_path, img, encode_params or [])
+        logger.debug("Writing image to %s, success: %s", out_path, ok)
         if not ok:
             raise RuntimeError(f"Failed to write path {out_path}")
         return name
@@ -110,9 +132,9 @@ class LocalImageFileRepo:
         if not subdir.is_dir():
             raise ValueError(f"Subpath is not a directory: {subdir}")
 
-        return LocalImageFileRepo(subdir)
+        return LocalImageFileRepo._for_existing_dir(subdir)
 
-    def store_images(self, imgs: List[MatLike], name: str) -> List[str]:
+    def store_images(self, imgs: List[MatLike], name: str, encode_params: List[int] | None = None) -> List[str]:
         """
         Store a list of images with a base name using store_image. Each image will be saved as name_0.webp, name_1.webp, etc.
         Returns a comma-separated string of file paths.
@@ -120,7 +142,7 @@ class LocalImageFileRepo:
         paths = []
         for idx, img in enumerate(imgs):
             img_name = f"{Path(name).stem}_{idx:03d}.webp"
-            path = self.store_image(img, img_name)
+            path = self.store_image(img, img_name, encode_params)
             paths.append(path)
         return paths
 
@@ -129,11 +151,6 @@ class LocalImageFileRepo:
         Retrieve an image by filename from the local directory.
         Raises FileNotFoundError if the image does not exist or cannot be read.
         """
-        try:
-            import cv2
-        except Exception as exc:
-            raise RuntimeError("LocalImageFileRepo requires opencv-python (cv2)") from exc
-
         # Only allow filename, no path traversal
         if Path(name).name != name:
             raise ValueError("name must be a filename without path components")
@@ -146,10 +163,7 @@ class LocalImageFileRepo:
             raise RuntimeError(f"cv2.imread failed to read image: {img_path}")
         return mat
 
-    def get_image_bytes(self, name: str) -> bytes:
-        """
-        Return the raw bytes of the image file, for use in zipping or direct download.
-        """
+    def _resolve_file(self, name: str) -> Path:
         img_path = Path(name)
         if not img_path.is_absolute():
             img_path = (self._dir / img_path).resolve()
@@ -159,9 +173,22 @@ class LocalImageFileRepo:
             raise ValueError(f"Attempted access outside repo directory: {img_path}")
         if not img_path.exists():
             raise FileNotFoundError(f"Image not found: {img_path}")
-        with open(img_path, "rb") as f:
+        return img_path
+
+    def get_image_bytes(self, name: str) -> bytes:
+        """
+        Return the raw bytes of the image file, for use in zipping or direct download.
+        """
+        with open(self._resolve_file(name), "rb") as f:
             return f.read()
 
+    def get_image_stream(self, name: str) -> ImageStream:
+        """
+        Open the image file for binary reading; the caller is responsible for closing `body`.
+        """
+        img_path = self._resolve_file(name)
+        return ImageStream(open(img_path, "rb"), size=img_path.stat().st_size)
+
 class PdfRetriever(Protocol):
     def get_pdf_bytes(self, name: str) -> bytes:
         ...
@@ -1,10 +1,16 @@
+from typing import Callable
+
 import cv2
 class PageFilter:
-    def __init__(self, considered_pages: set) -> None:
+    def __init__(self, considered_pages: set | frozenset) -> None:
         self.considered_pages = considered_pages
 
     def consider_page(self, page: int) -> bool:
         return len(self.considered_pages) == 0 or page in self.considered_pages
 
-    def filter_page(self, page: int, values: cv2.typing.MatLike ) -> bool:
+    def filter_page(self, page: int, values: cv2.typing.MatLike,
+                    embedded_text: Callable[[], str] | None = None) -> bool:
+        """
+        `embedded_text` lazily returns the page's own text layer, for filters that can decide without OCR.
+        """
         return self.consider_page(page)
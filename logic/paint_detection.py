@@ -1,5 +1,5 @@
 import re
-from typing import Callable, Any
+from typing import Callable, Any, Iterable
 
 PAINT_PATTERNS = [
     r"RLM ?\d+",
@@ -29,17 +29,22 @@ PAINT_KEYWORDS = [
     "div"
 ]
 
+# one alternation compiled at import: a single scan of the OCR text instead of one per pattern
+_PAINT_RE = re.compile("|".join(f"(?:{p})" for p in PAINT_PATTERNS), re.IGNORECASE)
+
+# a keyword counts if it occurs anywhere, even inside another one ("decal" in "decals"), so the
+# lookahead tries every position, longest keyword first, and a match also credits the keywords it contains
+_KEYWORD_RE = re.compile("(?=(" + "|".join(map(re.escape, sorted(PAINT_KEYWORDS, key=len, reverse=True))) + "))")
+_CONTAINED_KEYWORDS = {k: frozenset(o for o in PAINT_KEYWORDS if o in k) for k in PAINT_KEYWORDS}
+
 def find_paint_codes(text: str) -> set[str]:
-    codes = set()
-    for pattern in PAINT_PATTERNS:
-        for m in re.findall(pattern, text, flags=re.IGNORECASE):
-            code = m.upper().replace("  ", " ").strip()
-            codes.add(code)
-    return codes
+    return {m.group(0).upper().replace("  ", " ").strip() for m in _PAINT_RE.finditer(text)}
 
 def count_paint_keywords(text: str) -> int:
-    tl = text.lower()
-    return sum(1 if tl.count(k) > 0 else 0   for k in PAINT_KEYWORDS)
+    found = set()
+    for m in _KEYWORD_RE.finditer(text.lower()):
+        found |= _CONTAINED_KEYWORDS[m.group(1)]
+    return len(found)
 
 
 def score_painting_page(text:str) -> dict:
@@ -63,9 +68,20 @@ def score_painting_page(text:str) -> dict:
         "score": score,
     }
 
+def is_painting_text(chunks: Iterable[str], score_threshold: int = 5) -> bool:
+    """
+    Check if text arriving in chunks (e.g. OCR band by band) is a likely painting guide,
+    stopping as soon as the text seen so far reaches the threshold.
+    """
+    text = ""
+    for chunk in chunks:
+        text += chunk + "\n"
+        if score_painting_page(text)["score"] >= score_threshold:
+            return True
+    return False
+
 def is_painting_page(img, transformer: Callable[[Any], str], score_threshold: int = 5) -> bool :
     """
     Check if a page is a likely painting guide
     """
-    info = score_painting_page(transformer(img))
-    return  info["score"] >= score_threshold
\ No newline at end of file
+    return is_painting_text([transformer(img)], score_threshold)
\ No newline at end of file
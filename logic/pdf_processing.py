@@ -1,3 +1,9 @@
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import fitz
 import numpy as np
 import cv2
@@ -5,56 +11,136 @@ import time
 
 from .file_repo import ImageFileRepository
 from .page_filter import PageFilter
-from .utils import log_exec_time
+from .utils import log_exec_time, create_process_pool
 from .vehicle_extractor import vehicle_to_images
 
+logger = logging.getLogger(__name__)
+
+# fitz documents are not thread-safe, so each thread keeps the one it is rendering from and
+# reuses it for every page instead of re-parsing the PDF and rebuilding its page tree per page
+_thread_docs = threading.local()
+
+
+def _open_document(pdf_bytes) -> fitz.Document:
+    if getattr(_thread_docs, "source", None) is not pdf_bytes:
+        _release_document()
+        _thread_docs.doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        _thread_docs.source = pdf_bytes
+    return _thread_docs.doc
+
+
+def _release_document() -> None:
+    doc = getattr(_thread_docs, "doc", None)
+    if doc is not None:
+        doc.close()
+    _thread_docs.doc = None
+    _thread_docs.source = None
+
 
 # Helper: convert page -> cv2 image
 @log_exec_time
 def render_page_to_cv2(pdf_bytes, page_number, dpi=250):
     # Must open doc inside thread
-    print(f"Rendering page {page_number+1}...")
+    logger.debug("Rendering page %d...", page_number + 1)
 
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    doc = _open_document(pdf_bytes)
     page = doc.load_page(page_number)
 
     pix = page.get_pixmap(dpi=dpi)
 
-    # Use a supported format for PyMuPDF, then convert to WEBP with OpenCV
-    img_bytes = pix.tobytes("png")
-    arr = np.frombuffer(img_bytes, np.uint8)
-    img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-    # Return the decoded image (cv2 Mat), not the encoded WEBP buffer
-    return img
+    # Wrap the raw pixmap samples (no PNG encode/decode round-trip); the color conversion
+    # writes a new array, so the view does not outlive the pixmap
+    samples = np.frombuffer(pix.samples_mv, np.uint8).reshape(pix.height, pix.stride)
+    samples = samples[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+    if pix.n == 4:
+        return cv2.cvtColor(samples, cv2.COLOR_RGBA2BGR)
+    if pix.n == 1:
+        return cv2.cvtColor(samples, cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(samples, cv2.COLOR_RGB2BGR)
+
+
+# PDF shared by every task of a worker process, set once by the pool initializer
+_worker_pdf_bytes = None
+
+
+def _init_page_worker(pdf_bytes) -> None:
+    global _worker_pdf_bytes
+    _worker_pdf_bytes = pdf_bytes
 
 
 # Helper for process pool: must be top-level for pickling
 def process_page_worker(args):
     b, d, p, page_filter, out_repo = args
+    if b is None:
+        # pool tasks do not ship the PDF; it was handed to the worker once by _init_page_worker
+        b = _worker_pdf_bytes
     rendered = render_page_to_cv2(b, p, d)
-    if page_filter.filter_page(p, rendered):
+    return _filter_and_extract(p, rendered, page_filter, out_repo,
+                               lambda: _open_document(b).load_page(p).get_text("text"))
+
+
+def _filter_and_extract(p, rendered, page_filter: PageFilter, out_repo: ImageFileRepository, embedded_text):
+    if page_filter.filter_page(p, rendered, embedded_text):
        return p, vehicle_to_images(rendered, out_repo, p)
     return p, None
 
 
+def _process_pages_threaded(page_args, workers: int):
+    """
+    Render pages on the calling thread and overlap page filtering (OCR) and extraction on a
+    thread pool. PyMuPDF runs MuPDF single-threaded, so no fitz call may leave this thread:
+    the text layer is read here too, and at most `workers` rendered pages wait in the pool.
+    """
+    outputs = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as threads:
+        for b, d, p, page_filter, out_repo in page_args:
+            rendered = render_page_to_cv2(b, p, d)
+            text = _open_document(b).load_page(p).get_text("text")
+            pending.append(threads.submit(_filter_and_extract, p, rendered, page_filter, out_repo,
+                                          lambda text=text: text))
+            if len(pending) >= workers:
+                outputs.append(pending.popleft().result())
+        outputs.extend(future.result() for future in pending)
+    return outputs
+
+
 def process_pdf_pages(pdf_bytes, out_repo: ImageFileRepository, page_filter: PageFilter, dpi=250):
     start_time = time.perf_counter()
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    doc = _open_document(pdf_bytes)
     n = doc.page_count
     elapsed = time.perf_counter() - start_time
-    print(f"[timing] Processing {n} pages, page count taken {elapsed:.6f} seconds...")
+    logger.debug("[timing] Processing %d pages, page count taken %.6f seconds...", n, elapsed)
     results = [None] * n
     # Prepare args for only pages that pass consider_page
     page_args = [(pdf_bytes, dpi, i, page_filter, out_repo) for i in range(n) if page_filter.consider_page(i)]
 
     rendered = 0
     start_time = time.perf_counter()
-    # Sequential processing for AWS Lambda compatibility
-    for args in page_args:
-        page_number, img = process_page_worker(args)
-        if img is not None:
-            results[page_number] = img
-            rendered += 1
+    # rendering, OCR and extraction are CPU-bound Python/OpenCV work: spread pages across processes
+    executor = None
+    workers = min(os.cpu_count() or 1, len(page_args))
+    if len(page_args) > 1:
+        executor = create_process_pool(max_workers=workers,
+                                       initializer=_init_page_worker, initargs=(pdf_bytes,))
+    try:
+        if executor is not None:
+            with executor:
+                outputs = list(executor.map(process_page_worker,
+                                            [(None,) + args[1:] for args in page_args], chunksize=1))
+        elif len(page_args) > 1:
+            # no process pool (AWS Lambda): OpenCV and tesseract release the GIL, so OCR and
+            # extraction of earlier pages overlap with rendering the next one
+            outputs = _process_pages_threaded(page_args, workers)
+        else:
+            outputs = map(process_page_worker, page_args)
+        for page_number, img in outputs:
+            if img is not None:
+                results[page_number] = img
+                rendered += 1
+    finally:
+        # do not keep the PDF alive in a warm process once this request is done
+        _release_document()
     elapsed = time.perf_counter() - start_time
-    print(f"[timing] Rendered {rendered} pages in {elapsed:.6f} seconds...")
+    logger.debug("[timing] Rendered %d pages in %.6f seconds...", rendered, elapsed)
     return results
@@ -1,11 +1,35 @@
+import functools
+import logging
+import multiprocessing
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
 
 
 def log_exec_time(func):
+    """Log how long each call of `func` takes at DEBUG level; untimed when DEBUG is disabled."""
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start = time.perf_counter()
+        if not logger.isEnabledFor(logging.DEBUG):
+            return func(*args, **kwargs)
+        start = time.perf_counter_ns()
         result = func(*args, **kwargs)
-        elapsed = time.perf_counter() - start
-        print(f"[timing] {func.__name__} executed in {elapsed:.4f} seconds")
+        elapsed = (time.perf_counter_ns() - start) * 1e-9
+        logger.debug("[timing] %s executed in %.4f seconds", func.__qualname__, elapsed)
         return result
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+
+def create_process_pool(**kwargs) -> ProcessPoolExecutor | None:
+    """
+    Create a ProcessPoolExecutor, or return None where the platform cannot run one
+    (AWS Lambda has no /dev/shm, so multiprocessing locks fail) and callers should run inline.
+    Uses forkserver where available: forking the threaded web server process is unsafe.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        kwargs.setdefault("mp_context", multiprocessing.get_context("forkserver"))
+    try:
+        return ProcessPoolExecutor(**kwargs)
+    except (OSError, NotImplementedError):
+        return None
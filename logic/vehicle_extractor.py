@@ -1,3 +1,6 @@
+import logging
+import math
+
 import cv2
 import numpy as np
 from typing import List, Tuple
@@ -5,13 +8,29 @@ from typing import List, Tuple
 from .utils import log_exec_time
 from .file_repo import ImageFileRepository
 
+logger = logging.getLogger(__name__)
+
+# closing twice with a 5x5 rect is one closing with a 9x9 rect (OpenCV fuses rect iterations
+# into a single larger kernel), so say so directly
+_CLOSE_KERNEL: np.ndarray = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 9))
+_DILATE_KERNEL: np.ndarray = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+# shorter side of the image contours are detected on in extract_vehicles_inside_roi
+DETECT_MAX_SIDE = 1500
+# adaptive threshold neighbourhood of the extractor at full resolution
+_THRESH_BLOCK_SIZE = 31
+
+
+def _rect_kernel(size: float) -> np.ndarray:
+    k = max(1, round(size))
+    return cv2.getStructuringElement(cv2.MORPH_RECT, (k, k))
+
 
 @log_exec_time
 def vehicle_to_images(page_bytes, out_repo: ImageFileRepository,  page: int) -> str:
-    roi, roi_box = find_inner_roi(page_bytes, margin=10)
-    vehicles = extract_vehicles_inside_roi(roi, min_area_ratio=0.01)
+    roi, roi_gray, roi_box = find_inner_roi(page_bytes, margin=10)
+    vehicles = extract_vehicles_inside_roi(roi, min_area_ratio=0.01, gray=roi_gray)
 
-    print("Found", len(vehicles), "vehicle-like regions inside the box.")
+    logger.debug("Found %d vehicle-like regions inside the box.", len(vehicles))
 
     ret = out_repo.sub_repo("roi").store_image(roi,f"roi_pg{page}.webp")
     vehicles_repo = out_repo.sub_repo("vehicles")
@@ -19,11 +38,18 @@ def vehicle_to_images(page_bytes, out_repo: ImageFileRepository,  page: int) ->
     return ret
 
 
-def find_inner_roi(img, margin: int = 10) -> Tuple[np.ndarray, Tuple[int,int,int,int]]:
+def find_inner_roi(img, margin: int = 10,
+                   median_blur: bool = False) -> Tuple[np.ndarray, np.ndarray, Tuple[int,int,int,int]]:
+    """
+    Crop the page to just inside its biggest frame. Returns (roi, gray roi, roi box); the gray
+    crop is a view of the page's grayscale, so the extraction step does not convert again.
+    """
     h, w = img.shape[:2]
 
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = cv2.GaussianBlur(gray, (5, 5), 0)
+    gray_full = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # the 51x51 adaptive threshold already averages away pixel noise; only speckled scans
+    # need a (cheap) pre-filter
+    gray = cv2.medianBlur(gray_full, 3) if median_blur else gray_full
 
     bw = cv2.adaptiveThreshold(
         gray, 255,
@@ -35,7 +61,7 @@ def find_inner_roi(img, margin: int = 10) -> Tuple[np.ndarray, Tuple[int,int,int
     contours, _ = cv2.findContours(bw, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
     if not contours:
-        return img, (0, 0, w, h)
+        return img, gray_full, (0, 0, w, h)
 
     # Biggest external contour – usually the frame
     frame_cnt = max(contours, key=cv2.contourArea)
@@ -48,13 +74,43 @@ def find_inner_roi(img, margin: int = 10) -> Tuple[np.ndarray, Tuple[int,int,int
     y2_in = min(y + ch - margin, h)
 
     roi = img[y_in:y2_in, x_in:x2_in]
-    return roi, (x_in, y_in, x2_in - x_in,y2_in-y_in)
+    return roi, gray_full[y_in:y2_in, x_in:x2_in], (x_in, y_in, x2_in - x_in,y2_in-y_in)
+
+def _row_major_order(cx: np.ndarray, cy: np.ndarray, row_gap: float) -> Tuple[np.ndarray, int]:
+    """
+    Order candidates row-wise: sort by cy, start a new row whenever a candidate is more than
+    `row_gap` from the running mean cy of the current row, sort rows by mean cy (top-to-bottom)
+    and items inside a row by cx (left-to-right). Returns (candidate order, number of rows).
+    """
+    by_y = np.argsort(cy, kind="stable")
+    starts = [0]
+    row_sums = []
+    row_sum, row_len = 0.0, 0
+    for i, v in enumerate(cy[by_y].tolist()):
+        if row_len and abs(v - row_sum / row_len) > row_gap:
+            starts.append(i)
+            row_sums.append(row_sum)
+            row_sum, row_len = 0.0, 0
+        row_sum += v
+        row_len += 1
+    row_sums.append(row_sum)
+    starts.append(len(by_y))
+
+    bounds = np.asarray(starts)
+    row_means = np.asarray(row_sums) / np.diff(bounds)
+    order = []
+    for r in np.argsort(row_means, kind="stable").tolist():
+        row = by_y[bounds[r]:bounds[r + 1]]
+        order.append(row[np.argsort(cx[row], kind="stable")])
+    return np.concatenate(order), len(row_sums)
+
 
 def extract_vehicles_inside_roi(
     roi: np.ndarray,
     min_area_ratio: float = 0.01,
     debug: bool = False,
-    denoise: str = "nlmeans",  # "none", "gaussian", or "nlmeans"
+    denoise: str = "gaussian",  # "none", "gaussian", "adaptive", or "nlmeans"
+    gray: np.ndarray | None = None,
 ) -> List[np.ndarray]:
     """
     Extract vehicle crops and return them row-wise:
@@ -62,16 +118,38 @@ def extract_vehicles_inside_roi(
     - sort rows top-to-bottom,
     - within each row sort items left-to-right.
     Filtering rules retained to skip frame-like / overly-large contours.
-    denoise: 'none' (no denoising), 'gaussian' (fast, default), 'nlmeans' (slow, original)
+    denoise: 'none' (no denoising), 'gaussian' (fast, default), 'adaptive' (gaussian sized to the ROI),
+    'nlmeans' (slow, original)
+    gray: the ROI already converted to grayscale (e.g. by find_inner_roi), to skip converting it again
     """
-    h, w = roi.shape[:2]
+    roi_h, roi_w = roi.shape[:2]
+
+    if gray is None:
+        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+    # large ROIs are segmented on a reduced copy (thresholding, morphology and contours scale with
+    # pixel count); bounding boxes are mapped back and crops are still cut from the full-size ROI
+    block_size, close_kernel, dilate_kernel = _THRESH_BLOCK_SIZE, _CLOSE_KERNEL, _DILATE_KERNEL
+    if min(roi_h, roi_w) > DETECT_MAX_SIDE:
+        scale = DETECT_MAX_SIDE / min(roi_h, roi_w)
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # each reduced pixel covers 1/scale ROI pixels: shrink the neighbourhoods to match, or
+        # they would bridge and grow blobs as if they were 1/scale times bigger
+        block_size = max(3, 2 * round(_THRESH_BLOCK_SIZE // 2 * scale) + 1)
+        close_kernel = _rect_kernel(_CLOSE_KERNEL.shape[0] * scale)
+        dilate_kernel = _rect_kernel(_DILATE_KERNEL.shape[0] * scale)
+    h, w = gray.shape[:2]
     page_area = h * w
+    sx, sy = roi_w / w, roi_h / h
 
-    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
     if denoise == "none":
         denoised = gray
     elif denoise == "gaussian":
         denoised = cv2.GaussianBlur(gray, (3, 3), 0)
+    elif denoise == "adaptive":
+        # odd kernel of ~1% of the shorter side (3..9), sigma from OpenCV's own heuristic for that size
+        k = int(min(max(3, round(0.01 * min(h, w))), 9)) | 1
+        sigma = 0.3 * ((k - 1) * 0.5 - 1) + 0.8
+        denoised = cv2.GaussianBlur(gray, (k, k), sigma)
     elif denoise == "nlmeans":
         denoised = cv2.fastNlMeansDenoising(gray, None, 10, 7, 21)
     else:
@@ -81,12 +159,13 @@ def extract_vehicles_inside_roi(
         denoised, 255,
         cv2.ADAPTIVE_THRESH_MEAN_C,
         cv2.THRESH_BINARY_INV,
-        31, 5
+        block_size, 5
     )
 
-    kernel: np.ndarray = np.ones((5, 5), np.uint8)
-    bw = cv2.morphologyEx(bw, cv2.MORPH_CLOSE, kernel, iterations=2)
-    bw = cv2.dilate(bw, kernel, iterations=1)
+    bw = cv2.morphologyEx(bw, cv2.MORPH_CLOSE, close_kernel)
+    # the trailing dilate cannot be folded into the closing: it grows the contours whose areas
+    # the filters below compare against the page, and dropping it changes which crops survive
+    bw = cv2.dilate(bw, dilate_kernel)
 
     contours, _ = cv2.findContours(bw, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if not contours:
@@ -94,29 +173,35 @@ def extract_vehicles_inside_roi(
             print("[debug] no contours found")
         return []
 
-    contours_sorted = sorted(contours, key=cv2.contourArea, reverse=True)
+    # compute each contour's area once and keep them in the same (descending, stable) order
+    areas = np.fromiter((cv2.contourArea(c) for c in contours), dtype=np.float64, count=len(contours))
+    by_area = np.argsort(-areas, kind="stable")
+    contours_sorted = [contours[i] for i in by_area]
+    areas_sorted = areas[by_area]
     frame_candidate = contours_sorted[0]
     fx, fy, fw, fh = cv2.boundingRect(frame_candidate)
     frame_rect_area = fw * fh
 
-    margin = 5
-    touches_left   = fx <= margin
-    touches_top    = fy <= margin
-    touches_right  = (fx + fw) >= (w - margin)
-    touches_bottom = (fy + fh) >= (h - margin)
-
-    peri = cv2.arcLength(frame_candidate, True)
-    approx = cv2.approxPolyDP(frame_candidate, 0.02 * peri, True)
-    is_quad = (len(approx) == 4) and cv2.isContourConvex(approx)
-
-    frame_aspect = (fw / fh) if fh != 0 else 0.0
-    roi_aspect = (w / h) if h != 0 else 0.0
-    aspect_ok = abs(frame_aspect - roi_aspect) < 0.35
-
-    is_frame_like = (
-        (frame_rect_area > 0.6 * page_area and touches_left and touches_top and touches_right and touches_bottom)
-        or (frame_rect_area > 0.5 * page_area and is_quad and aspect_ok)
-    )
+    # both frame tests need a bounding rect over half the page; most pages have no frame, so the
+    # polygon approximation of the (long) largest contour is only paid for when it could be one
+    is_frame_like = False
+    if frame_rect_area > 0.5 * page_area:
+        margin = 5
+        touches_left   = fx <= margin
+        touches_top    = fy <= margin
+        touches_right  = (fx + fw) >= (w - margin)
+        touches_bottom = (fy + fh) >= (h - margin)
+
+        if frame_rect_area > 0.6 * page_area and touches_left and touches_top and touches_right and touches_bottom:
+            is_frame_like = True
+        else:
+            frame_aspect = (fw / fh) if fh != 0 else 0.0
+            roi_aspect = (w / h) if h != 0 else 0.0
+            aspect_ok = abs(frame_aspect - roi_aspect) < 0.35
+            if aspect_ok:
+                peri = cv2.arcLength(frame_candidate, True)
+                approx = cv2.approxPolyDP(frame_candidate, 0.02 * peri, True)
+                is_frame_like = (len(approx) == 4) and cv2.isContourConvex(approx)
 
     # thresholds
     max_area_ratio = 0.5
@@ -124,86 +209,70 @@ def extract_vehicles_inside_roi(
     border_margin = 3
     near_full_area_thresh = 0.98
 
-    # collect candidates with bbox info for robust grouping
-    candidates = []
-    for i, cnt in enumerate(contours_sorted):
-        if i == 0 and is_frame_like:
-            if debug:
-                print("[debug] skipping frame candidate")
-            continue
-
-        area = cv2.contourArea(cnt)
-        if area < page_area * min_area_ratio:
-            continue
-
-        vx, vy, vw, vh = cv2.boundingRect(cnt)
-
-        if vw >= w * bbox_full_thresh or vh >= h * bbox_full_thresh:
-            continue
-
-        if area >= page_area * near_full_area_thresh:
-            continue
-
-        if vx <= border_margin or vy <= border_margin or (vx + vw) >= (w - border_margin) or (vy + vh) >= (h - border_margin):
-            continue
-
-        if area > page_area * max_area_ratio:
+    # pixel thresholds derived once per page; the masks and the loop below only compare against them
+    min_area = page_area * min_area_ratio
+    max_area = page_area * max_area_ratio
+    near_full_area = page_area * near_full_area_thresh
+    # areas are sorted descending, so the contours large enough to be vehicles are a prefix;
+    # bounding boxes are only needed for those, and the box/area filters run as masks over them
+    n_big = int(np.count_nonzero(areas_sorted >= min_area))
+    bboxes = np.array([cv2.boundingRect(c) for c in contours_sorted[:n_big]], dtype=np.int32).reshape(-1, 4)
+    big_areas = areas_sorted[:n_big]
+    vx, vy, vw, vh = bboxes.T
+    keep = (
+        (vw < w * bbox_full_thresh) & (vh < h * bbox_full_thresh)
+        & (big_areas < near_full_area)
+        & (vx > border_margin) & (vy > border_margin)
+        & (vx + vw < w - border_margin) & (vy + vh < h - border_margin)
+        & (vw * vh < near_full_area)
+    )
+    if is_frame_like:
+        if debug:
+            print("[debug] skipping frame candidate")
+        keep[:1] = False
+
+    # collect candidates with bbox info for robust grouping, as parallel arrays (one slot per contour)
+    cand_cx = np.empty(n_big, dtype=np.float64)
+    cand_cy = np.empty(n_big, dtype=np.float64)
+    cand_h = np.empty(n_big, dtype=np.float64)
+    crops: List[np.ndarray] = []
+    for i in np.flatnonzero(keep).tolist():
+        if big_areas[i] > max_area:
+            cnt = contours_sorted[i]
             peri_c = cv2.arcLength(cnt, True)
             approx_c = cv2.approxPolyDP(cnt, 0.02 * peri_c, True)
             is_rect_like = (len(approx_c) == 4) and cv2.isContourConvex(approx_c)
             if is_rect_like:
                 continue
 
-        if vw == w and vh == h:
-            continue
-
-        crop = roi[vy : vy + vh, vx : vx + vw]
-        if crop.shape == roi.shape and np.array_equal(crop, roi):
-            continue
+        x, y, cw, ch = bboxes[i].tolist()
+        if (w, h) != (roi_w, roi_h):
+            x0, y0 = int(x * sx), int(y * sy)
+            cw = min(math.ceil((x + cw) * sx), roi_w) - x0
+            ch = min(math.ceil((y + ch) * sy), roi_h) - y0
+            x, y = x0, y0
 
-        if (vw * vh) >= page_area * near_full_area_thresh:
-            continue
+        n = len(crops)
+        cand_cx[n] = x + cw / 2.0
+        cand_cy[n] = y + ch / 2.0
+        cand_h[n] = ch
+        crops.append(roi[y : y + ch, x : x + cw])
 
-        cx = vx + vw / 2.0
-        cy = vy + vh / 2.0
-        candidates.append({"cx": cx, "cy": cy, "x": vx, "y": vy, "vw": vw, "vh": vh, "area": area, "crop": crop})
-
-    if not candidates:
+    if not crops:
         if debug:
             print("[debug] no candidates after filtering")
         return []
+    n = len(crops)
 
     # determine a sensible y-gap to separate rows:
-    heights = np.array([c["vh"] for c in candidates], dtype=float)
-    median_h = float(np.median(heights)) if heights.size else 0.0
-    row_gap = max(10.0, median_h * 0.8, h * 0.04)  # pixels
-
-    # sort by cy then group into rows by proximity using running mean
-    candidates.sort(key=lambda c: c["cy"])
-    rows = []
-    for c in candidates:
-        if not rows:
-            rows.append([c])
-            continue
-        row = rows[-1]
-        mean_cy = float(np.mean([it["cy"] for it in row]))
-        if abs(c["cy"] - mean_cy) <= row_gap:
-            row.append(c)
-        else:
-            rows.append([c])
-
-    # sort rows by their mean y (top-to-bottom) and items inside by x ascending (left-to-right)
-    for row in rows:
-        row.sort(key=lambda it: it["cx"])
-    rows.sort(key=lambda r: float(np.mean([it["cy"] for it in r])))
+    median_h = float(np.median(cand_h[:n]))
+    row_gap = max(10.0, median_h * 0.8, roi_h * 0.04)  # pixels
 
+    order, row_count = _row_major_order(cand_cx[:n], cand_cy[:n], row_gap)
     # flatten into final ordered list (row by row)
-    ordered_crops: List[np.ndarray] = []
-    for row in rows:
-        for it in row:
-            ordered_crops.append(it["crop"])
+    ordered_crops: List[np.ndarray] = [crops[i] for i in order]
 
     if debug:
-        print(f"[debug] rows={len(rows)}, total_items={len(ordered_crops)}, row_gap={row_gap:.1f}")
+        print(f"[debug] rows={row_count}, total_items={len(ordered_crops)}, row_gap={row_gap:.1f}")
 
     return ordered_crops
\ No newline at end of file
@@ -0,0 +1,48 @@
+import io
+import os
+
+from aws.s3_logic import _ETagCache
+
+
+class _FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        data = self.objects[Key]
+        return {"Body": io.BytesIO(data), "ETag": f'"{Key}-etag"'}
+
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path))
+
+
+def test_new_cache_counts_and_evicts_files_left_in_shared_dir(tmp_path):
+    limit = 2000
+    objects = {f"k{i}": bytes([i]) * 400 for i in range(12)}
+    s3 = _FakeS3(objects)
+
+    first = _ETagCache(tmp_path, disk_limit=limit, memory_limit=0)
+    for key in list(objects)[:6]:
+        first.get(s3, "bucket", key)
+    assert _dir_size(tmp_path) <= limit
+
+    # a second process over the same directory starts with the first one's files on disk
+    second = _ETagCache(tmp_path, disk_limit=limit, memory_limit=0)
+    assert second._disk_size == _dir_size(tmp_path)
+    for key in list(objects)[6:]:
+        second.get(s3, "bucket", key)
+    assert _dir_size(tmp_path) <= limit
+    assert second._disk_size == _dir_size(tmp_path)
+
+
+def test_new_cache_evicts_oldest_preexisting_files_down_to_limit(tmp_path):
+    for i in range(5):
+        path = tmp_path / f"etag{i}"
+        path.write_bytes(b"x" * 1000)
+        os.utime(path, (i, i))
+
+    cache = _ETagCache(tmp_path, disk_limit=2500, memory_limit=0)
+
+    assert sorted(os.listdir(tmp_path)) == ["etag3", "etag4"]
+    assert cache._disk_size == 2000